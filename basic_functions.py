@@ -1,39 +1,97 @@
 """ Module defining functions used throughout the project. """
 
+import sys
+import math
 import time
+import asyncio
 import textwrap
+from collections import OrderedDict
 
 CONSOLE_WIDTH = 100 # for wrapping
+TIMESTAMP_INDENT = ' ' * len('[HH:MM:SS] ') # aligns wrapped lines after the timestamp
+# Wrappers for the first line and for subsequent lines of a message.
+FIRST_LINE_WRAPPER = textwrap.TextWrapper(
+  width=CONSOLE_WIDTH,
+  subsequent_indent=TIMESTAMP_INDENT
+)
+LINE_WRAPPER = textwrap.TextWrapper(
+  width=CONSOLE_WIDTH,
+  initial_indent=TIMESTAMP_INDENT,
+  subsequent_indent=TIMESTAMP_INDENT
+)
+LOG_QUEUE_SIZE = 1000 # max pending log messages before writing synchronously
+log_queue: asyncio.Queue | None = None # only set while `log_writer` is running
+timestamp_cache = [0, ''] # [unix second, formatted timestamp of that second]
+
+
+def get_timestamp() -> str:
+  """ Return the current '[HH:MM:SS] ' timestamp, formatting it once per second. """
+  now = int(time.time())
+  if timestamp_cache[0] != now:
+    timestamp_cache[0] = now
+    timestamp_cache[1] = time.strftime('[%H:%M:%S] ', time.localtime(now))
+  return timestamp_cache[1]
+
+
+def write_stdout(text: str) -> None:
+  """ Write to stdout and flush. """
+  sys.stdout.write(text)
+  sys.stdout.flush()
+
+
+async def log_writer() -> None:
+  """ Write messages queued by `debug_print` to stdout in a worker thread,
+      batching everything queued since the last write.
+      `debug_print` writes synchronously unless this is running. """
+  global log_queue
+  log_queue = queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+  try:
+    while True:
+      batch = [await queue.get()]
+      while not queue.empty():
+        batch.append(queue.get_nowait())
+      await asyncio.to_thread(write_stdout, ''.join(batch))
+  finally:
+    # Don't lose queued messages if the task is cancelled.
+    log_queue = None
+    batch = []
+    while not queue.empty():
+      batch.append(queue.get_nowait())
+    write_stdout(''.join(batch))
 
 
 def debug_print(*args, **kwargs):
-  """ Print to console with flush=True; Timestamp, justify, and indent string. """
+  """ Print to console (see `log_writer`); Timestamp, justify, and indent string. """
   sep = kwargs.get('sep', ' ')
   end = kwargs.get('end', '\n')
-  time_str = time.strftime('[%H:%M:%S] ')
+  time_str = get_timestamp()
   # Create semifinal string
   text = time_str + sep.join(map(str, args))
+  # Most messages are a single short line: skip wrapping them.
+  if len(text) <= CONSOLE_WIDTH and '\n' not in text:
+    output = text.strip()
+  else:
+    output = wrap_lines(text)
+  # Hand off to `log_writer` if it's running; if not (or it's backed up), write now.
+  if log_queue is not None:
+    try:
+      log_queue.put_nowait(output + end)
+      return
+    except asyncio.QueueFull:
+      pass
+  write_stdout(output + end)
+
+
+def wrap_lines(text: str) -> str:
+  """ Wrap each line of a timestamped message, indenting past the timestamp. """
   # Split lines to preverve line breaks and join after wrapping.
   lines = text.split('\n')
-  output = '\n'.join([
+  return '\n'.join([
     # initial line(s) (pre-'\n')
-    textwrap.fill(
-      lines[0],
-      width=CONSOLE_WIDTH,
-      subsequent_indent=' ' * len(time_str)
-    ),
+    FIRST_LINE_WRAPPER.fill(lines[0]),
     # subsequent lines
-    *[
-      textwrap.fill(
-        line,
-        width=CONSOLE_WIDTH,
-        initial_indent=' ' * len(time_str),
-        subsequent_indent=' ' * len(time_str)
-      )
-      for line in lines[1:]
-    ]
+    *[LINE_WRAPPER.fill(line) for line in lines[1:]],
   ]).strip()
-  print(output, end=end, flush=True)
 
 
 def create_elo_function(
@@ -42,23 +100,38 @@ def create_elo_function(
     xtimes: float = 10, # ... is `xtimes` times as likely to win"
   ):
   """ Create and return a personalized Elo calculation function. """
+  scale = math.log(xtimes) / diff # xtimes ** (d / diff) == exp(d * scale)
   def elo_function(p1, p2: float, p1_wins: float) -> dict[str, float]:
     # p1_wins: 0 = loss, 1 = win, 0.5 = Draw
-    p1_expected: float = 1 / (1 + xtimes ** ((p2 - p1) / diff))
-    p2_expected: float = 1 / (1 + xtimes ** ((p1 - p2) / diff))
+    p1_expected: float = 1 / (1 + math.exp((p2 - p1) * scale))
+    p2_expected: float = 1 - p1_expected # the expectations always sum to 1
     p1_gain = K * (p1_wins - p1_expected)
     p2_gain = K * ((1 - p1_wins) - p2_expected)
     return {"p1_gain": p1_gain, "p2_gain": p2_gain}
   return elo_function
 
 
-def async_cache(func):
-  """ Cache the result of an async function. """
-  cache = {}
-  async def wrapper(arg):
-    if arg in cache:
-      return cache[arg]
-    result = await func(arg)
-    cache[arg] = result
-    return result
-  return wrapper
+def async_cache(maxsize: int = 10_000, ttl: float | None = None):
+  """ Cache the results of a single-argument async function.
+      Concurrent calls with the same argument share one task; failed calls
+      aren't cached. Evict the least recently used result past `maxsize`
+      entries, and expire results after `ttl` seconds (never, if None). """
+  def decorator(func):
+    cache: OrderedDict = OrderedDict() # arg -> (expiry time, task)
+    async def wrapper(arg):
+      if arg in cache:
+        expiry, task = cache[arg]
+        failed = task.done() and (task.cancelled() or task.exception() is not None)
+        if not failed and (expiry is None or time.monotonic() < expiry):
+          cache.move_to_end(arg)
+          # Shield the shared task so one cancelled caller doesn't cancel it for all.
+          return await asyncio.shield(task)
+        del cache[arg]
+      task = asyncio.create_task(func(arg))
+      expiry = None if ttl is None else time.monotonic() + ttl
+      cache[arg] = (expiry, task)
+      if len(cache) > maxsize:
+        cache.popitem(last=False)
+      return await asyncio.shield(task)
+    return wrapper
+  return decorator
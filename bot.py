@@ -2,7 +2,6 @@
 
 # Not (yet) implemented:
 #   A customized ping system based on region/platform/Elo (not useful for now)
-#   API rate limiter (but shouldn't be a problem)
 
 # TODO: test lobby cooldown
 # TODO: idenfity bug that sometimes breaks `playerdata`
@@ -17,6 +16,7 @@ from typing import Literal
 import asyncio
 import time
 
+import aiohttp
 import discord
 from discord.ext import commands
 from discord import app_commands
@@ -24,18 +24,30 @@ from dotenv import load_dotenv
 
 from players import PlayerManager, Player
 from lobby_manager import LobbyManager
-from basic_functions import debug_print
+from basic_functions import debug_print, log_writer
+from rate_limiter import safe_send
 
 # Players
 AUTOSAVE = True         # whether to autosave
 AUTOSAVE_BACKUPS = True # whether to back up previous data while autosaving
 AUTOSAVE_PERIOD = 10*60 # seconds between each autosave
+PLAYER_CACHE_SIZE = 50_000 # max number of Discord users to remember the Player of
 
 # Lobbies
 KEEPALIVE_DURATION = 30 * 60  # seconds; initial time to keep a lobby alive for
 REFRESH_DURATION = 3 * 60     # seconds; time to keep a lobby alive without activity
 COOLDOWN_TIME = 30            # minimum time (seconds) between /result reports
 
+# Logging
+LOG_LEVEL = 1 # 1: log messages' raw text; 2: log their "clean" text (mentions resolved)
+
+# Autoreplies
+AUTOREPLY_COOLDOWN = 10*60 # minimum time (seconds) between autoreplies to the same user
+
+# Messages
+LEADERBOARD_SIZE = 100 # max number of players shown by /leaderboard
+MESSAGE_LIMIT = 2000   # max characters in a Discord message
+
 REPORT_STR = "Report bugs to DWouu." # string to append to certain messages
 # Note: HELP_STRING does not include admin-only commands
 HELP_STRING = """-# Note: "lobby" here refers to the object which this Discord bot keeps track of internally.
@@ -107,11 +119,20 @@ intents = discord.Intents.default()
 intents.message_content = True  # see (incoming messages'?) content
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Mentions to allow in messages that ping roles/users (never @everyone/@here).
+MENTION_ROLES = discord.AllowedMentions(everyone=False, users=False, roles=True)
+MENTION_USERS = discord.AllowedMentions(everyone=False, users=True, roles=False)
+
 
 async def main():
-  """ Initialize PlayerManager, set class variables, start autosave,
-      and start the bot. """
+  """ Start the log writer, initialize PlayerManager, set class variables,
+      start autosave, and start the bot. """
+  # Run new tasks immediately until they first suspend, skipping a trip
+  # through the event loop for tasks that finish (or block) right away.
+  asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+  asyncio.create_task(log_writer())
   PlayerManager.initialize()
+  player_cache.clear()
   LobbyManager.KEEPALIVE_DURATION = KEEPALIVE_DURATION
   LobbyManager.REFRESH_DURATION = REFRESH_DURATION
   LobbyManager.COOLDOWN_TIME = COOLDOWN_TIME
@@ -119,6 +140,16 @@ async def main():
     asyncio.create_task(
       PlayerManager.autosave(period=AUTOSAVE_PERIOD, backup=AUTOSAVE_BACKUPS)
     )
+  asyncio.create_task(prune_autoreply_times())
+  # Pool and keep alive connections to Discord's API, and cache DNS lookups.
+  # Note: `bot.http` is internal to discord.py (the public way is the Bot's
+  # `connector=` argument), but the connector has to be made in a running
+  # loop, and `bot` is created at import time for its decorators.
+  bot.http.connector = aiohttp.TCPConnector(
+    limit=100,
+    ttl_dns_cache=300,
+    keepalive_timeout=75,
+  )
   load_dotenv()
   await bot.start(getenv("DISCORD_TOKEN"))
 
@@ -138,16 +169,15 @@ async def on_ready() -> None:
 @bot.event
 async def on_message(msg: discord.message.Message) -> None:
   """ Handle new messages. """
-  # Skip DMs.
-  if not msg.guild:
+  # Skip DMs and bot messages.
+  if not msg.guild or msg.author.bot:
     return
 
-  # Print message.
-  debug_print(f"[{msg.author.display_name}]: {msg.clean_content}")
-
-  # Skip bot messages.
-  if msg.author.bot:
-    return
+  # Print message. `clean_content` resolves mentions, which costs a regex pass.
+  if LOG_LEVEL >= 2:
+    debug_print(f"[{msg.author.display_name}]: {msg.clean_content}")
+  else:
+    debug_print(f"[{msg.author.display_name}]: {msg.content}")
 
   # Handle automatic replies.
   await handle_autoreply(msg)
@@ -156,6 +186,25 @@ async def on_message(msg: discord.message.Message) -> None:
   await bot.process_commands(msg)
 
 
+@bot.event
+async def on_guild_role_create(role: discord.Role) -> None:
+  """ Forget any cached lookup for the new role's name. """
+  role_cache.pop((role.guild.id, role.name), None)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role) -> None:
+  """ Forget cached lookups for the role's old and new names. """
+  role_cache.pop((before.guild.id, before.name), None)
+  role_cache.pop((after.guild.id, after.name), None)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role) -> None:
+  """ Forget the cached lookup for the deleted role. """
+  role_cache.pop((role.guild.id, role.name), None)
+
+
 @bot.event
 async def on_interaction(itx: discord.Interaction):
   """ Log incoming slash commands. """
@@ -257,7 +306,7 @@ async def ranked(
     footer = f"_-# **{REPORT_STR}**_"
     if ping_users == "Ping users":
       role_name = f"{region}-T7-{platform}"
-      role = discord.utils.get(itx.guild.roles, name=role_name)
+      role = get_role(itx.guild, role_name)
       header = f"{role.mention} :speaking_head::mega: {user.mention}"\
         " just opened a ranked lobby!\n"
       body = this_player.get_summary()
@@ -273,7 +322,7 @@ async def ranked(
   try:
     await itx.response.send_message(
       text,
-      allowed_mentions=discord.AllowedMentions(roles=True)
+      allowed_mentions=MENTION_ROLES
     )
 
     # Add a reminder to the sender to invite people.
@@ -307,7 +356,7 @@ async def invite(
     footer = "-# Use `/join` to join their lobby"
     await itx.response.send_message(
       body + '\n' + footer,
-      allowed_mentions=discord.AllowedMentions(users=True)
+      allowed_mentions=MENTION_USERS
     )
 
 
@@ -372,13 +421,14 @@ async def result(
     return
 
   # Fetch the player's opponent.
-  opponent = next((player for player in lobby['players'] if player != this_player), None)
-  if opponent is None:
+  players = lobby['players']
+  if len(players) < 2:
     await itx.response.send_message(
       "You're in an empty lobby.",
       ephemeral=True
     )
     return
+  opponent = players[1] if players[0] is this_player else players[0]
 
   # Determine the winner.
   if match_result == "I won":
@@ -394,8 +444,8 @@ async def result(
     # Update match log directly, without reporting the match result.
     LobbyManager.update_match_log(lobby['region'], lobby['platform'], winner, loser, undo=True)
     # Undo the cooldown so the result can be reported again.
-    now = time.time()
-    lobby['last_interaction'] = now - LobbyManager.COOLDOWN_DURATION
+    now = time.monotonic()
+    lobby['last_interaction'] = now - LobbyManager.COOLDOWN_TIME
     result_text = "Noted undo (bot has to be reloaded for it to take effect)."
   else:
     # Try to report the result (check if match is on cooldown).
@@ -425,6 +475,7 @@ async def ban_ranked(
   """ Ban a user from using the ranked bot. """
   this_player = get_player(user)
   this_player.banned = True
+  player_cache.pop(user.id, None)
   await itx.response.send_message(
     f"{this_player.display_name} got banned lmao", ephemeral=True
   )
@@ -448,10 +499,16 @@ async def leaderboard(
   """ Display a leaderboard for the region/platform. """
   if platform == 'Steam':
     platform = 'PC'
-  # Fetch players that match this region/platform who aren't banned.
-  players = [player for player in PlayerManager.players.values()
-              if (region,platform) in player.records
-              and not player.banned]
+  key = (region, platform)
+  # Fetch the top players that match this region/platform who aren't banned.
+  # The leaderboard is already sorted by elo, descending.
+  players = []
+  for _,ID in PlayerManager.leaderboards.get(key, []):
+    player = PlayerManager.players[ID]
+    if not player.banned:
+      players.append(player)
+      if len(players) == LEADERBOARD_SIZE:
+        break
 
   # Handle regions with no players.
   if not players:
@@ -461,25 +518,32 @@ async def leaderboard(
     )
     return
 
-  # Sort the players by elo, descending.
-  players.sort(
-    key=lambda player: player.records[(region,platform)]['elo'],
-    reverse=True
-  )
-
   # Format each output line.
-  lines = []
-  for player in players:
-    record = player.records[(region,platform)]
-    elo_str = str(int(record['elo']))
-    elo_prefix = '~' if record['matches_total'] < 30 else ' '
-    lines.append(f"{elo_prefix + elo_str:>5} │ {player.display_name}")
-
-  # Print the result.
+  records = [(player, player.records[key]) for player in players]
+  lines = [
+    f"{('~' if record['matches_total'] < 30 else ' ') + str(int(record['elo'])):>5}"
+    f" │ {player.display_name}"
+    for player,record in records
+  ]
+
+  # Split the lines into pages that fit in a message.
   header = "``` Elo  │ Player\n"\
               "──────┼─────────────────\n"
-  output = header + '\n'.join(lines) + "```"
-  await itx.response.send_message(output, ephemeral=True)
+  footer = "```"
+  pages = [[]]
+  page_length = len(header) + len(footer)
+  for line in lines:
+    if pages[-1] and page_length + len(line) + 1 > MESSAGE_LIMIT:
+      pages.append([])
+      page_length = len(header) + len(footer)
+    pages[-1].append(line)
+    page_length += len(line) + 1
+
+  # Print the result, sending any extra pages as followups.
+  outputs = [header + '\n'.join(page) + footer for page in pages]
+  await itx.response.send_message(outputs[0], ephemeral=True)
+  for output in outputs[1:]:
+    await itx.followup.send(output, ephemeral=True)
 
 
 ##############
@@ -491,7 +555,7 @@ async def leaderboard(
 @bot.command(name='ping')
 async def ping(ctx: discord.ext.commands.context.Context) -> None:
   """ A simple ping-pong test to see if the bot is online. """
-  await ctx.send("Pong!")
+  await safe_send(ctx.channel.id, ctx.send, "Pong!")
 
 
 ###################
@@ -499,26 +563,64 @@ async def ping(ctx: discord.ext.commands.context.Context) -> None:
 ###################
 
 
+player_cache: dict[int, Player] = {} # Discord user ID -> Player
+
+
 def get_player(user: discord.member.Member) -> Player:
   """ Resolve a Player from their Discord user.
       Use this to interface with PlayerManager players, as it can update
       the Player's display name. """
-  user_id = str(user.id)
-  player = PlayerManager.get_player(user_id)
+  player = player_cache.get(user.id)
+  if player is None:
+    player = PlayerManager.get_player(str(user.id))
+    # Forget the oldest entry if the cache is full.
+    if len(player_cache) >= PLAYER_CACHE_SIZE:
+      del player_cache[next(iter(player_cache))]
+    player_cache[user.id] = player
   # Resolve and save display name.
   if not player.display_name:
     player.display_name = user.global_name if user.global_name else user.display_name
   return player
 
 
+role_cache: dict[tuple[int, str], discord.Role] = {} # (guild ID, role name) -> role
+
+
+def get_role(guild: discord.Guild, role_name: str) -> discord.Role | None:
+  """ Find a guild's role by name, caching the result.
+      The role events above keep the cache up to date. """
+  key = (guild.id, role_name)
+  if key not in role_cache:
+    role = discord.utils.get(guild.roles, name=role_name)
+    if role is None:
+      return None
+    role_cache[key] = role
+  return role_cache[key]
+
+
+# Autoreply patterns; compiled once since every guild message is checked.
+ACHIEVEMENT_PATTERN = re.compile(r'achiev.?m|trophy')
+BEGGAR_PATTERN = re.compile(r'(?:(?:final|last).{0,20}|help.{0,40})(?:achiev.?m|trophy)')
+autoreply_times: dict[int, float] = {} # user ID -> time of the last autoreply to them
+
+
+async def prune_autoreply_times() -> None:
+  """ Periodically forget users whose autoreply cooldown has expired. """
+  while True:
+    await asyncio.sleep(AUTOREPLY_COOLDOWN)
+    now = time.monotonic()
+    for user_id,last_reply in list(autoreply_times.items()):
+      if now - last_reply >= AUTOREPLY_COOLDOWN:
+        del autoreply_times[user_id]
+
+
 async def handle_autoreply(msg: discord.message.Message) -> None:
   """ Apply all automatic replies to a message. """
   text = msg.content
   # Match achievement beggars.
   # Skip users who mention "ranked" and not "tournament".
-  if (re.search(r'(final|last).{0,20}(achiev.?m|trophy)', text)
-       or re.search(r'help.{0,40}(achiev.?m|trophy)', text)
-       or ('tourn' in text and re.search(r'(achiev.?m|trophy)', text))
+  if (BEGGAR_PATTERN.search(text)
+       or ('tourn' in text and ACHIEVEMENT_PATTERN.search(text))
       ) and not ('ranked' in text and 'tourn' not in text):
     debug_print(f"[{msg.author.display_name}]: {msg.clean_content}")
     debug_print('^ Partial beggar match.')
@@ -526,13 +628,26 @@ async def handle_autoreply(msg: discord.message.Message) -> None:
     player = get_player(msg.author)
     games_played = sum(record["matches_total"] for record in player.records.values())
     if games_played == 0:
+      # Reply at most once per cooldown to each user.
+      now = time.monotonic()
+      if now - autoreply_times.get(msg.author.id, -AUTOREPLY_COOLDOWN) < AUTOREPLY_COOLDOWN:
+        debug_print('^ Full beggar match - on cooldown.')
+        return
+      autoreply_times[msg.author.id] = now
       debug_print('^ Full beggar match - responded.')
-      await msg.channel.send(
+      await safe_send(
+        msg.channel.id, msg.channel.send,
         "You probably won't find anyone to help with getting the"\
         f" tournament achievement here {msg.author.mention}",
-        allowed_mentions=discord.AllowedMentions(users=True)
+        allowed_mentions=MENTION_USERS
       )
 
 
 if __name__ == "__main__":
-  asyncio.run(main())
+  # Run on uvloop's faster event loop where it's installed (it isn't on Windows).
+  try:
+    import uvloop
+  except ImportError:
+    asyncio.run(main())
+  else:
+    uvloop.run(main())
@@ -3,6 +3,8 @@
 import time
 import asyncio
 import os
+import sys
+import heapq
 from players import Player, PlayerManager
 from basic_functions import debug_print, create_elo_function
 
@@ -16,93 +18,118 @@ class LobbyManager():
   lobbies: dict[int, dict] = {} # lobby ID -> {}
   # `lobbies`: key identifier(1,2,3,...) -> dict:
   #   "ID": int,
-  #   "region":_, "platform":_,
-  #   "start_time":_, "last_interaction":_,
-  #   "players": set[Player],
+  #   "region":_, "platform":_, "key": (region, platform) with interned strings,
+  #   "start_time":_, "last_interaction":_, (time.monotonic() values)
+  #   "players": tuple[Player, ...] (host first, at most 2),
   #   "records": dict[Player, dict[W/L/D/matches_total -> int]]
   #   "invited_players": set[Player]
+  player_lobbies: dict[Player, dict] = {} # Player -> the lobby they're in
+  free_lobby_ids: list[int] = list(range(1,1000)) # min-heap (sorted) of unused lobby IDs
+  match_log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "match_log.csv")
+  sweeper_started: bool = False # whether `__lobby_sweeper` is running
 
   @classmethod
-  async def __lobby_autocloser(cls, lobby: dict) -> None:
-    """ Periodically check if it's time to close a lobby based on last_interaction."""
-    sleep_duration = cls.KEEPALIVE_DURATION
-    start_time = time.time()
+  async def __lobby_sweeper(cls) -> None:
+    """ Periodically close every lobby that has expired based on its
+        start_time and last_interaction. """
     while True:
-      await asyncio.sleep(sleep_duration)
-      now = time.time()
-      sleep_duration = \
-        max(
+      await asyncio.sleep(cls.REFRESH_DURATION)
+      now = time.monotonic()
+      for lobby in list(cls.lobbies.values()):
+        expiry_time = max(
           lobby['last_interaction'] + cls.REFRESH_DURATION, # since the last refresh
-          start_time + cls.KEEPALIVE_DURATION, # since lobby creation
-        ) - now
-      if sleep_duration < 0:
-        debug_print(f"Closing lobby #{lobby['ID']}.")
-        del cls.lobbies[lobby['ID']]
-        return
+          lobby['start_time'] + cls.KEEPALIVE_DURATION, # since lobby creation
+        )
+        if expiry_time < now:
+          debug_print(f"Closing lobby #{lobby['ID']}.")
+          cls.close_lobby(lobby)
+
+  @classmethod
+  def close_lobby(cls, lobby: dict) -> None:
+    """ Remove a lobby and any players still in it. """
+    for player in lobby['players']:
+      del cls.player_lobbies[player]
+    del cls.lobbies[lobby['ID']]
+    heapq.heappush(cls.free_lobby_ids, lobby['ID'])
 
   @classmethod
   async def new_lobby(cls,
       player: Player,
       region: str,
       platform: str,
-      do_not_autoclose: bool=False
     ) -> dict:
     """ Create lobby if player not already in a lobby; return lobby.
-        Raise ValueError if `player` is already in a lobby on this platform.
+        Raise ValueError if `player` is already in a lobby on this platform,
+        or if all lobby IDs are in use.
         Raise PermissionError if `player` is banned. """
+    lobby = cls._create_lobby(player, region, platform)
+
+    # Start the task that automatically closes lobbies, if needed.
+    if not cls.sweeper_started:
+      cls.sweeper_started = True
+      asyncio.create_task(cls.__lobby_sweeper())
+    return lobby
+
+  @classmethod
+  def _create_lobby(cls, player: Player, region: str, platform: str) -> dict:
+    """ `new_lobby` without starting the lobby sweeper; usable outside of
+        an event loop. """
     if player.banned:
       raise PermissionError("Player is banned from ranked.")
 
     # Check if the player is already in a lobby.
-    for lobby in cls.lobbies.values():
-      if player in lobby["players"]:
-        raise ValueError(f"Player {player.display_name} is already in a lobby.")
+    if player in cls.player_lobbies:
+      raise ValueError(f"Player {player.display_name} is already in a lobby.")
 
     # Make sure the player has a record with this region+platform.
-    _ = player.get_record(region, platform)
-
-    # Find a free lobby ID and create a lobby using it.
-    for lobby_id in range(1,1000):
-      if lobby_id not in cls.lobbies:
-        now = time.time()
-        lobby = {
-          "ID": lobby_id,
-          "region": region,
-          "platform": platform,
-          "start_time": now,
-          "last_interaction": now,
-          "players": {player,},
-          "records": { # keep a temporary match result record for each player
-            player: {'matches_total': 0, 'W': 0, 'L': 0, 'D': 0},
-          },
-          "invited_players": {player,},
-        }
-        cls.lobbies[lobby_id] = lobby
-
-        # Spawn a task to automatically close the lobby.
-        if not do_not_autoclose:
-          asyncio.create_task(cls.__lobby_autocloser(lobby))
-        return lobby
+    key = (sys.intern(region), sys.intern(platform))
+    _ = player.get_record(*key)
+
+    # Take the lowest free lobby ID and create a lobby using it.
+    if not cls.free_lobby_ids:
+      raise ValueError("Too many lobbies are open; try again later.")
+    lobby_id = heapq.heappop(cls.free_lobby_ids)
+    now = time.monotonic()
+    lobby = {
+      "ID": lobby_id,
+      "region": region,
+      "platform": platform,
+      "key": key, # for Player.records
+      "start_time": now,
+      "last_interaction": now,
+      "players": (player,),
+      "records": { # keep a temporary match result record for each player
+        player: {'matches_total': 0, 'W': 0, 'L': 0, 'D': 0},
+      },
+      "invited_players": {player,},
+    }
+    cls.lobbies[lobby_id] = lobby
+    cls.player_lobbies[player] = lobby
+    return lobby
 
   @classmethod
   def update_lobby(cls, lobby: dict) -> None:
     """ Refresh a lobby's last_interaction time. """
-    now = time.time()
+    now = time.monotonic()
     lobby['last_interaction'] = now
 
   @classmethod
   def find_lobby(cls, player: Player) -> dict:
     """ Find the first lobby `player` is in and return it.
         Raise ValueError if the player isn't in a lobby. """
-    for lobby in cls.lobbies.values():
-      if player in lobby['players']:
-        return lobby
-    raise ValueError("Player not in a lobby.")
+    try:
+      return cls.player_lobbies[player]
+    except KeyError as e:
+      raise ValueError("Player not in a lobby.") from e
 
   @classmethod
   def invite_to_lobby(cls, host: Player, guest: Player) -> None:
     """ Mark a lobby as having had invited `invitee`. """
-    lobby = cls.find_lobby(host)
+    cls._invite(cls.find_lobby(host), guest)
+
+  @classmethod
+  def _invite(cls, lobby: dict, guest: Player) -> None:
+    """ `invite_to_lobby` for an already-found lobby. """
     lobby['invited_players'].add(guest)
 
   @classmethod
@@ -119,15 +146,17 @@ class LobbyManager():
       lobby = cls.find_lobby(host)
     except ValueError as e:
       raise ValueError(f"Host \"{host.display_name}\" isn't in a lobby.") from e
+    cls._join(lobby, joiner)
 
-    # Check if joiner is aleady in the lobby.
-    if joiner in lobby['players']:
+  @classmethod
+  def _join(cls, lobby: dict, joiner: Player) -> None:
+    """ `join_lobby` for an already-found lobby, after the ban check. """
+    # Check if joiner is aleady in this lobby or in another lobby.
+    joiner_lobby = cls.player_lobbies.get(joiner)
+    if joiner_lobby is lobby:
       raise ValueError("You're already in this lobby.")
-
-    # Check if joiner is in another lobby.
-    for lobby2 in cls.lobbies.values():
-      if joiner in lobby2['players'] and lobby2 != lobby:
-        raise ValueError("You're already in another lobby (use `/leave` to leave).")
+    if joiner_lobby is not None:
+      raise ValueError("You're already in another lobby (use `/leave` to leave).")
 
     # Check if lobby is full.
     if len(lobby['players']) > 1:
@@ -138,7 +167,8 @@ class LobbyManager():
       raise PermissionError("You haven't been invited to this lobby (the host has to `/invite` you).")
 
     # Add the joiner to the lobby and update the lobby.
-    lobby['players'].add(joiner)
+    lobby['players'] += (joiner,)
+    cls.player_lobbies[joiner] = lobby
     lobby['records'][joiner] = {'matches_total': 0, 'W': 0, 'L': 0, 'D': 0}
     cls.update_lobby(lobby)
 
@@ -150,7 +180,8 @@ class LobbyManager():
       lobby = cls.find_lobby(player)
     except ValueError:
       raise ValueError("Player not in a lobby.")
-    lobby['players'].remove(player)
+    lobby['players'] = tuple(p for p in lobby['players'] if p is not player)
+    del cls.player_lobbies[player]
     del lobby['records'][player]
     cls.update_lobby(lobby)
     # Do not manually close an empty lobby - let close automatically
@@ -165,12 +196,20 @@ class LobbyManager():
         Return a formatted string representing the match results.
         `winner` can be either player in a draw.
         Raise RuntimeError if the lobby is still on cooldown. """
-    lobby = cls.find_lobby(winner)
-    region = lobby['region']
-    platform = lobby['platform']
+    return cls._report(cls.find_lobby(winner), winner, draw, log_result)
+
+  @classmethod
+  def _report(cls,
+      lobby: dict,
+      winner: Player,
+      draw: bool,
+      log_result: bool
+    ) -> str:
+    """ `report_match_result` for an already-found lobby. """
+    key = lobby['key']
 
     # Check if lobby is still on cooldown.
-    now = time.time()
+    now = time.monotonic()
     wait_duration = lobby['last_interaction'] + cls.COOLDOWN_TIME - now
     if wait_duration > 0:
       raise RuntimeError(
@@ -178,57 +217,86 @@ class LobbyManager():
       )
 
     # Update the lobby records.
-    # Let Player p1 be the winner, and p2 the loser.
-    PlayerManager.should_save = True
-    p1,p2 = None,None
-    if not draw:
-      for player,record in lobby['records'].items():
-        record['matches_total'] += 1
-        if player == winner:
-          record['W'] += 1
-          p1 = player
-        else:
-          record['L'] += 1
-          p2 = player
+    # Let Player p1 be the winner, and p2 the loser (in a draw, p1 is the host).
+    players = lobby['players']
+    if draw:
+      p1,p2 = players
     else:
-      for player,record in lobby['records'].items():
-        record['matches_total'] += 1
-        record['D'] += 1
-        if p1 is None:
-          p1 = player
-        elif p2 is None:
-          p2 = player
-
-    # Fetch current Elos.
-    p1_old_elo = p1.get_elo(region, platform)
-    p2_old_elo = p2.get_elo(region, platform)
-
-    # Make sure p1 has the lower elo if there's a draw (for displaying elo change).
+      p1 = winner
+      p2 = players[1] if players[0] is winner else players[0]
+    p1_record = lobby['records'][p1]
+    p2_record = lobby['records'][p2]
+    p1_record['matches_total'] += 1
+    p2_record['matches_total'] += 1
     if draw:
-      if p1_old_elo > p2_old_elo:
-        p1,p2 = p2,p1
-        p1_old_elo = p1.get_elo(region, platform)
-        p2_old_elo = p2.get_elo(region, platform)
+      p1_record['D'] += 1
+      p2_record['D'] += 1
+    else:
+      p1_record['W'] += 1
+      p2_record['L'] += 1
 
-    # Calculate Elos and update both players.
-    result = cls.ELO_FUNCTION(p1_old_elo, p2_old_elo, p1_wins=(0.5 if draw else 1))
-    p1_new_elo = p1_old_elo + result['p1_gain']
-    p2_new_elo = p2_old_elo + result['p2_gain']
-    p1.records[(region, platform)]['elo'] = p1_new_elo
-    p2.records[(region, platform)]['elo'] = p2_new_elo
-    p1.records[(region, platform)]['matches_total'] += 1
-    p2.records[(region, platform)]['matches_total'] += 1
+    # Update both players.
+    PlayerManager.should_save = True
+    result = cls.apply_match(p1, p2, key, draw=draw)
+    p1,p2 = result['p1'],result['p2']
+    PlayerManager.update_leaderboard(p1, key, result['p1_old_elo'])
+    PlayerManager.update_leaderboard(p2, key, result['p2_old_elo'])
 
     # Log the result.
     if log_result:
-      cls.update_match_log(region, platform, p1, p2, draw=draw)
+      cls.update_match_log(*key, p1, p2, draw=draw)
 
     # Format the return the results string.
+    p1_tag,p2_tag = ('D','D') if draw else ('W','L')
+    p1_old,p2_old = int(result['p1_old_elo']), int(result['p2_old_elo'])
+    p1_new,p2_new = int(result['p1_new_elo']), int(result['p2_new_elo'])
+    p1_gain,p2_gain = round(result['p1_gain']), round(result['p2_gain'])
     result_text = \
-      f"[{'D' if draw else 'W'}] {p1.display_name} :green_square: {int(p1_old_elo)} **(+{round(result['p1_gain'])})** ➜ __{int(p1_new_elo)}__"\
-      f"\n[{'D' if draw else 'L'}] {p2.display_name} :red_square: {int(p2_old_elo)} **({round(result['p2_gain'])})** ➜ __{int(p2_new_elo)}__"
+      f"[{p1_tag}] {p1.display_name} :green_square: {p1_old} **(+{p1_gain})** ➜ __{p1_new}__"\
+      f"\n[{p2_tag}] {p2.display_name} :red_square: {p2_old} **({p2_gain})** ➜ __{p2_new}__"
     return result_text
 
+  @classmethod
+  def apply_match(cls,
+      p1: Player,
+      p2: Player,
+      key: tuple[str, str],
+      draw: bool = False
+    ) -> dict:
+    """ Update the (region, platform) `key` Elos and records of `p1` (the
+        winner) and `p2` (the loser).
+        Return a dict with "p1", "p2", and their "_old_elo", "_new_elo", and
+        "_gain" values; in a draw, p1 and p2 are swapped if needed so that p1
+        has the lower Elo. Only touches the players' records: doesn't update
+        the leaderboards or mark PlayerManager as needing a save. """
+    # Fetch current records and Elos.
+    p1_record = p1.get_record(*key)
+    p2_record = p2.get_record(*key)
+    p1_old_elo = p1_record['elo']
+    p2_old_elo = p2_record['elo']
+
+    # Make sure p1 has the lower elo if there's a draw (for displaying elo change).
+    if draw and p1_old_elo > p2_old_elo:
+      p1,p2 = p2,p1
+      p1_record,p2_record = p2_record,p1_record
+      p1_old_elo,p2_old_elo = p2_old_elo,p1_old_elo
+
+    # Calculate Elos and update both players.
+    result = cls.ELO_FUNCTION(p1_old_elo, p2_old_elo, p1_wins=(0.5 if draw else 1))
+    p1_new_elo = p1_old_elo + result['p1_gain']
+    p2_new_elo = p2_old_elo + result['p2_gain']
+    p1_record['elo'] = p1_new_elo
+    p2_record['elo'] = p2_new_elo
+    p1_record['matches_total'] += 1
+    p2_record['matches_total'] += 1
+
+    return {
+      "p1": p1, "p2": p2,
+      "p1_old_elo": p1_old_elo, "p2_old_elo": p2_old_elo,
+      "p1_new_elo": p1_new_elo, "p2_new_elo": p2_new_elo,
+      "p1_gain": result['p1_gain'], "p2_gain": result['p2_gain'],
+    }
+
   @classmethod
   def update_match_log(cls,
       region: str,
@@ -239,9 +307,9 @@ class LobbyManager():
       undo: bool = False,
     ) -> str:
     """ Create a timestamped log entry in 'match_log.csv'. """
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(this_dir, "match_log.csv")
-    with open(file_path, 'a+', encoding='u8') as f:
+    # Reopen the file for each entry, in case it was edited (e.g. to handle
+    # an "Undo") or replaced while the bot is running.
+    with open(cls.match_log_path, 'a', encoding='u8') as f:
       f.write(
         ','.join([
           str(int(time.time())),        # timestamp
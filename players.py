@@ -5,6 +5,7 @@ import json
 import time
 import asyncio # to autoclose lobbies
 from copy import copy
+from bisect import bisect_left, insort
 from basic_functions import debug_print
 
 DEFAULT_ELO = 1000.0 # only used for new Players
@@ -16,6 +17,8 @@ class PlayerManager():
   players: dict[str, Player] = {}
   id_map: dict[str, str] = {} # curr -> prev; TODO: add user-facing interface
   should_save: bool = False # dirty "bit" to track changes
+  # (region,platform) -> [(-elo, ID), ...] sorted, for players with matches played
+  leaderboards: dict[tuple[str, str], list[tuple[float, str]]] = {}
 
   @classmethod
   def initialize(cls, filename: str = 'data.json'):
@@ -61,6 +64,34 @@ class PlayerManager():
       debug_print(f'Reading {ref_id} -> {orig_id}')
       cls.id_map[ref_id] = orig_id
 
+    cls.rebuild_leaderboards()
+
+  @classmethod
+  def rebuild_leaderboards(cls) -> None:
+    """ Rebuild every leaderboard from the players' records. """
+    cls.leaderboards = {}
+    for player in cls.players.values():
+      for key,record in player.records.items():
+        if record['matches_total']:
+          cls.leaderboards.setdefault(key, []).append((-record['elo'], player.ID))
+    for leaderboard in cls.leaderboards.values():
+      leaderboard.sort()
+
+  @classmethod
+  def update_leaderboard(cls,
+      player: Player,
+      key: tuple[str, str],
+      old_elo: float
+    ) -> None:
+    """ Move `player` to their current Elo's place in the (region, platform)
+        `key` leaderboard, adding them if they weren't listed (at `old_elo`). """
+    leaderboard = cls.leaderboards.setdefault(key, [])
+    old_entry = (-old_elo, player.ID)
+    i = bisect_left(leaderboard, old_entry)
+    if i < len(leaderboard) and leaderboard[i] == old_entry:
+      del leaderboard[i]
+    insort(leaderboard, (-player.records[key]['elo'], player.ID))
+
   @classmethod
   def debug_print_players(cls) -> None:
     """ Print all players, for debugging. """
@@ -0,0 +1,64 @@
+""" Module defining a token bucket rate limiter for messages sent to Discord channels. """
+
+import asyncio
+import random
+from collections import defaultdict
+
+import discord
+
+from basic_functions import debug_print
+
+GLOBAL_RATE = 45      # requests per second; below Discord's global limit of 50
+CHANNEL_RATE = 5 / 5  # requests per second; Discord allows 5 messages per 5 seconds per channel
+CHANNEL_BURST = 5     # requests a channel can send at once before being throttled
+MAX_RETRIES = 8       # retries after a 429 (rate limited) response
+MAX_BACKOFF = 60      # seconds; upper bound on the wait between retries
+
+
+class TokenBucket():
+  """ Allow `rate` acquisitions per second, in bursts of up to `burst`. """
+  def __init__(self, rate: float, burst: int) -> None:
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.last_refill = None
+    self.lock = asyncio.Lock() # serialize waiters so tokens are handed out in order
+
+  async def acquire(self) -> None:
+    """ Wait until a token is available, then consume it. """
+    async with self.lock:
+      loop = asyncio.get_running_loop()
+      now = loop.time()
+      if self.last_refill is not None:
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+      self.last_refill = now
+      if self.tokens < 1:
+        await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.tokens = 1.0
+        self.last_refill = loop.time()
+      self.tokens -= 1
+
+
+global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+channel_buckets: dict[int, TokenBucket] = defaultdict(
+  lambda: TokenBucket(CHANNEL_RATE, CHANNEL_BURST)
+)
+
+
+async def safe_send(channel_id: int, send_func, *args, **kwargs):
+  """ Await `send_func(*args, **kwargs)` once both the global and the
+      channel's bucket allow it, and return its result.
+      Retry with exponential backoff (plus jitter) on HTTP 429.
+      Only use this for messages created in a channel: interaction responses
+      don't count against these limits, and must be sent within 3 seconds. """
+  for attempt in range(MAX_RETRIES + 1):
+    await global_bucket.acquire()
+    await channel_buckets[channel_id].acquire()
+    try:
+      return await send_func(*args, **kwargs)
+    except discord.HTTPException as e:
+      if e.status != 429 or attempt == MAX_RETRIES:
+        raise
+      delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.5)
+      debug_print(f"Rate limited; retrying in {delay:.1f} seconds.")
+      await asyncio.sleep(delay)